@@ -0,0 +1,149 @@
+"""
+This script uses TSRCore to answer a batch of queries with the dataset loaded only once.
+Queries are read as NDJSON (one JSON object per line) from a file or stdin,
+and ranked targets are streamed out as NDJSON, one line per query, as each query completes.
+Each query may set "id" (required), "relation", "mode", "L1", "L2", "allowed" (list of target ids),
+"top_k", "max_relations" and "relation_order", otherwise the commandline defaults are used.
+Distances are only calculated for the items each query uses, so small batches start quickly.
+"""
+import argparse
+import contextlib
+import json
+import sys
+import TSRCore as core
+import util
+
+
+def main():
+
+    # Get inputs
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input", "-i", "--in",
+                        help="Path to JSON file containing labelled items with embeddings")
+    parser.add_argument("--queries", "-q", default='-',
+                        help="Path to NDJSON file of queries. Read from stdin if not set")
+    parser.add_argument("--out", "-o", "--output", default='-',
+                        help="Path for NDJSON file to output results. Written to stdout if not set")
+    parser.add_argument("--pos", "-p", "--positive",
+                        help="Default name of positive relation label")
+    parser.add_argument("--mode", "-m", default='a',
+                        help="Default scoring algorithm (a to q)")
+    parser.add_argument("--top", "-k", type=int,
+                        help="Default number of top targets to output. All targets are output if not set")
+    parser.add_argument("--max-relations", type=int,
+                        help="Default maximum number of relations to follow from each similar item. Unlimited if not set")
+    parser.add_argument("--relation-order", choices=['closeness', 'weight'], default='closeness',
+                        help="Which relations to follow when capped: closest to the query or highest stored weight")
+
+    args = parser.parse_args()
+
+    inPath = args.input or input(
+        "\nENTER PATH OF INPUT FILE:\n")
+
+    defaults = {
+        'relation': args.pos,
+        'mode': args.mode,
+        'L1': 5,
+        'L2': 10,
+        'top_k': args.top,
+        'max_relations': args.max_relations,
+        'relation_order': args.relation_order
+    }
+
+    with contextlib.ExitStack() as stack:
+        queries = sys.stdin if args.queries == '-' else stack.enter_context(open(args.queries))
+        out = sys.stdout if args.out == '-' else stack.enter_context(open(args.out, 'w'))
+
+        # Keep progress messages out of the results
+        stack.enter_context(contextlib.redirect_stdout(sys.stderr))
+
+        items = core.distancesLazy(util.readJSONFile(inPath))
+
+        for result in runQueries(queries, items, defaults):
+            out.write(json.dumps(result) + '\n')
+            out.flush()
+
+
+def runQueries(lines, items, defaults):
+    """
+    Generates one result for each line of NDJSON query specs in lines
+    Queries are answered one at a time so only one result is held in memory
+    """
+    nodes = {item['id']: item for item in items}
+    degrees = {}
+
+    for line in lines:
+        if not line.strip():
+            continue
+
+        spec = {}
+        try:
+            spec = {**defaults, **json.loads(line)}
+
+            # Report the relation fan-out the first time each relation is used
+            if spec['relation'] and spec['relation'] not in degrees:
+                degrees[spec['relation']] = core.relationDegrees(items, spec['relation'])
+                print(f"\nRELATION {spec['relation']} DEGREES: {degrees[spec['relation']]}")
+
+            yield runQuery(spec, nodes, items)
+        except Exception as e:
+            yield {'id': spec.get('id'), 'error': str(e)}
+
+
+def runQuery(spec, nodes, items):
+    """
+    Ranks targets for one query spec, with the query removed from the dataset
+    """
+    if spec['id'] not in nodes:
+        raise ValueError(f'Unknown query id {spec["id"]}')
+    if not spec['relation']:
+        raise ValueError('No relation given')
+
+    query = nodes[spec['id']]
+
+    # Remove the query from the dataset
+    safe_items = [item for item in items if item is not query]
+
+    allowed_target_ids = spec.get('allowed') or [item['id'] for item in safe_items]
+
+    # Rank
+    stats = {}
+    ranked = core.infer(
+        max_similar=spec['L1'],
+        max_related=spec['L2'],
+        query=query,
+        items=safe_items,
+        allowed_target_ids=allowed_target_ids,
+        relation_type=spec['relation'],
+        mode=spec['mode'],
+        top_k=spec['top_k'],
+        max_relations=spec['max_relations'],
+        relation_order=spec['relation_order'],
+        stats=stats
+    )
+
+    return {
+        'id': spec['id'],
+        'relation': spec['relation'],
+        'mode': spec['mode'],
+        'capped': stats.get('capped', 0),
+        'results': [outputTarget(target) for target in ranked]
+    }
+
+
+def outputTarget(target):
+    """
+    Returns the score and shortest route of a ranked target
+    """
+    route = target['routes'][0]
+    return {
+        'target_id': target['target_id'],
+        'score': float(target['score']),
+        'similar_id': route['similar_node']['id'],
+        'related_id': route['related_node']['id'],
+        'distance': float(route['distance'])
+    }
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+"""
+This script uses TSRCore to rank targets for every item in a dataset in one pass
+and outputs a CSV recommendation table with the top scoring targets for each item.
+Only scoring algorithms that can be expressed as sparse matrix products are supported.
+"""
+import argparse
+import TSRCore as core
+import util
+
+
+def main():
+
+    # Get inputs
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input", "-i", "--in",
+                        help="Path to JSON file containing labelled items with embeddings")
+    parser.add_argument("--out", "-o", "--output",
+                        help="Path for CSV file to output recommendations")
+    parser.add_argument("--pos", "-p", "--positive",
+                        help="Name of positive relation label")
+    parser.add_argument("--mode", "-m",
+                        help="Scoring algorithm (a, a*, b, c, d, i or j)")
+    parser.add_argument("--top", "-k", type=int, default=10,
+                        help="Number of top targets to output for each item")
+    parser.add_argument("--precision", choices=['float16', 'int8'],
+                        help="Quantise embeddings to reduce memory use. Full precision if not set")
+    parser.add_argument("--rerank", type=int, default=100,
+                        help="Number of nearest items to recalculate exactly when quantising embeddings")
+
+    args = parser.parse_args()
+
+    inPath = args.input or input(
+        "\nENTER PATH OF INPUT FILE:\n")
+
+    relation_pos = args.pos or input(
+        "\nENTER NAME OF POSITIVE RELATION LABEL:\n")
+
+    mode = args.mode or input(
+        "\nSELECT SCORING ALGORITHM:\n")
+
+    outPath = args.out or input(
+        "\nENTER PATH OF OUTPUT FILE:\n")
+
+    items = util.readJSONFile(inPath)
+
+    # Pre-calculate cosine distance for all items
+    items = core.distancesSemantic(items, args.precision, args.rerank)
+
+    # Rank all targets for all items
+    scores = core.inferAll(
+        max_similar=5,
+        max_related=10,
+        items=items,
+        relation_type=relation_pos,
+        mode=mode,
+        top_k=args.top
+    )
+
+    rows = recommendationRows(scores, items, relation_pos, mode)
+    print(f'\nFOUND {len(rows)} RECOMMENDATIONS FOR {len(items)} ITEMS')
+
+    if rows:
+        print('\nSAVING TO FILE: '+outPath)
+        util.writeCSV(outPath, rows)
+
+
+def recommendationRows(scores, items, relation_type, mode):
+    """
+    Converts a sparse matrix of scores from inferAll into a list of dicts,
+    one per recommended target in descending order of score for each query
+    """
+    rows = []
+    for i in range(0, len(items)):
+        start, end = scores.indptr[i], scores.indptr[i+1]
+        for rank, (j, score) in enumerate(zip(scores.indices[start:end], scores.data[start:end])):
+            rows.append({
+                'query_id': items[i]['id'],
+                'rank': rank,
+                'target_id': items[j]['id'],
+                'score': score,
+                'relation': relation_type,
+                'scoring_mode': mode
+            })
+    return rows
+
+
+if __name__ == '__main__':
+    main()
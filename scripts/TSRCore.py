@@ -3,17 +3,44 @@ This script contains an implementation of the TSR inference algorithm.
 To use the infer function, you will first need a list of items with distances,
 these can be calculated using the distancesSemantic function.
 """
-import sklearn.preprocessing as preprocessing
-import sklearn.metrics as metrics
 import numpy as np
+import heapq
+import importlib
+from itertools import islice
 
 
-def distancesSemantic(items):
+class _LazyModule:
+    """
+    Imports a module the first time one of its attributes is used,
+    as sklearn and scipy are slow to import and not every caller needs them
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+preprocessing = _LazyModule('sklearn.preprocessing')
+metrics = _LazyModule('sklearn.metrics')
+sparse = _LazyModule('scipy.sparse')
+
+
+def distancesSemantic(items, precision=None, rerank=None):
     """
     Adds to each item an ordered list of distances to all other items.
     The distance is 1 - the cosine similarity of their embeddings.
+    If precision is 'float16' or 'int8', the embedding of each item is replaced by a quantised copy
+    to reduce memory use, and the rerank nearest items to each item are recalculated at float32 precision.
     """
 
+    if precision:
+        return _distancesQuantised(items, precision, rerank)
+
     embeddings = [item['embedding'] for item in items]
     print("\nCALCULATING COSINE DISTANCES...")
     distances = metrics.pairwise.cosine_distances(embeddings, embeddings)
@@ -30,13 +57,150 @@ def distancesSemantic(items):
     return items
 
 
-def infer(max_similar, max_related, query, items, allowed_target_ids, relation_type, mode):
+def distancesLazy(items):
+    """
+    Like distancesSemantic, but the distances of each item are only calculated
+    the first time they are used, which is faster when only a few items are queried.
+    Returns a new list of items, distances may differ from distancesSemantic by rounding error.
+    """
+    embeddings = np.array([item['embedding'] for item in items], dtype=float)
+    norms = np.linalg.norm(embeddings, axis=1)
+    norms[norms == 0] = 1
+    embeddings /= norms[:, np.newaxis]
+    ids = [item['id'] for item in items]
+
+    return [_LazyDistancesItem(item, i, embeddings, ids) for i, item in enumerate(items)]
+
+
+class _LazyDistancesItem(dict):
+    """
+    Item dict which calculates its 'distances' the first time they are used
+    """
+
+    def __init__(self, item, index, embeddings, ids):
+        super().__init__(item)
+        self._index = index
+        self._embeddings = embeddings
+        self._ids = ids
+
+    def __missing__(self, key):
+        if key != 'distances':
+            raise KeyError(key)
+
+        distances = np.clip(1 - self._embeddings @ self._embeddings[self._index], 0, 2)
+        order = np.argsort(distances, kind='stable')
+        order = order[order != self._index]  # Ignore distance to self
+
+        # list of shape [distance, id]
+        self['distances'] = [(distances[j], self._ids[j]) for j in order]
+        return self['distances']
+
+
+def quantiseEmbeddings(embeddings, precision):
+    """
+    Normalises embeddings to unit length and stores them at precision ('float16' or 'int8')
+    Returns the quantised embeddings and the scale of each row, so that
+    the cosine similarity of rows i and j is approximately (codes[i] . codes[j]) * scales[i] * scales[j]
+    """
+    embeddings = preprocessing.normalize(np.asarray(embeddings, dtype=np.float32))
+
+    if precision == 'float16':
+        return embeddings.astype(np.float16), np.ones(len(embeddings), dtype=np.float32)
+
+    if precision == 'int8':
+        # Symmetric scalar quantisation of each row to the range -127 to 127
+        scales = np.abs(embeddings).max(axis=1) / 127
+        scales[scales == 0] = 1
+        codes = np.round(embeddings / scales[:, np.newaxis]).astype(np.int8)
+        return codes, scales.astype(np.float32)
+
+    raise ValueError(f'Unknown embedding precision {precision}')
+
+
+def _distancesQuantised(items, precision, rerank, block=1024):
+    """
+    distancesSemantic storing embeddings at precision to reduce memory use.
+    Each item's 'embedding' is replaced by its quantised codes, with 'embedding_scale'
+    such that codes * scale approximates the embedding normalised to unit length.
+    Candidate neighbours are found from the codes in blocks of rows, then the rerank nearest
+    to each item are recalculated from a float32 copy of the embeddings, which is then released.
+    """
+    N = len(items)
+    embeddings = preprocessing.normalize(
+        np.asarray([item['embedding'] for item in items], dtype=np.float32))
+    codes, scales = quantiseEmbeddings(embeddings, precision)
+
+    # Store the codes in place of the full precision embeddings
+    for item, code, scale in zip(items, codes, scales):
+        item['embedding'] = code
+        item['embedding_scale'] = float(scale)
+
+    print(f"\nCALCULATING COSINE DISTANCES FROM {precision.upper()} EMBEDDINGS "
+          f"({codes[0].nbytes} BYTES PER ITEM)...")
+
+    for start in range(0, N, block):
+
+        # NumPy has no fast integer matrix product, so blocks of codes are multiplied as float32
+        # Products of int8 codes are exact in float32 for embeddings up to 1040 dimensions
+        rows = codes[start:start+block].astype(np.float32)
+        similarities = np.empty((len(rows), N), dtype=np.float32)
+        for col in range(0, N, block):
+            similarities[:, col:col+block] = rows @ codes[col:col+block].astype(np.float32).T
+        similarities *= scales[start:start+block, np.newaxis] * scales[np.newaxis, :]
+
+        for i in range(0, len(rows)):
+            index = start + i
+            distances = 1 - similarities[i].astype(float)
+
+            order = np.argsort(distances, kind='stable')
+            order = order[order != index]  # Ignore distance to self
+
+            if rerank:
+                # Recalculate the nearest candidates from the float32 embeddings and restore the order
+                candidates = order[:rerank]
+                distances[candidates] = 1 - embeddings[candidates].astype(float) @ embeddings[index]
+                order = order[np.argsort(distances[order], kind='stable')]
+
+            # list of shape [distance, id]
+            items[index]['distances'] = [(distances[j], items[j]['id']) for j in order]
+
+    return items
+
+
+def infer(max_similar, max_related, query, items, allowed_target_ids, relation_type, mode,
+          top_k=None, max_relations=None, relation_order='closeness', stats=None):
     """
     Ranks targets by the distance from the input to the target passing
     through exactly one relation which is given as a distance of 0.
     Approx comparisons = min(max_similar, labelled items) * min(max_related, items) * average labels per item
     items should be dicts with the keys 'id' and 'distances', an ordered list of distances to other items
     if there is no distance entry from one item to another, it is assumed to be unreachable
+    If top_k is set, only the top_k highest scoring targets are returned.
+    For mode a, route discovery also stops once no unexplored route can enter the top_k,
+    so the routes listed for each returned target may not be exhaustive.
+    max_relations, relation_order and stats limit the relations followed per similar item, see findRoutes.
+    """
+
+    routes = findRoutes(max_similar, max_related, query, items, allowed_target_ids, relation_type,
+                        prune=top_k if mode == 'a' else None, max_relations=max_relations,
+                        relation_order=relation_order, stats=stats)
+
+    return _scoreRoutes(routes, mode, top_k)
+
+
+def findRoutes(max_similar, max_related, query, items, allowed_target_ids, relation_type,
+               prune=None, max_relations=None, relation_order='closeness', stats=None):
+    """
+    Returns all routes from the query to allowed targets, as used by infer.
+    Each route is tagged with the rank of its similar node among the labelled items most similar
+    to the query, and the rank of its target among the allowed targets most similar to the related
+    node (None for the related node itself), so that rankRoutes can score smaller L1 and L2.
+    If prune is set, routes which cannot reach the prune shortest targets are skipped,
+    except for the first route found to each target, so that ties are broken as without pruning.
+    If max_relations is set, at most that many relations are followed from each similar item,
+    choosing the related items closest to the query, or with the highest weight if relation_order
+    is 'weight' (weights are read from the list '<relation_type>_weights' of the similar item).
+    If stats is a dict, the number of similar items capped and relations skipped are added to it.
     """
 
     L1 = max_similar
@@ -44,42 +208,77 @@ def infer(max_similar, max_related, query, items, allowed_target_ids, relation_t
     H = query
     O = []
 
+    # Distances are sorted, so routes longer than the prune-th
+    # shortest target distance can be skipped
+    best = {}  # Shortest known distance per target
+    threshold = np.inf
+    query_distances = None  # Distance from the query to each item, if needed to cap relations
+
     labelled_items = itemsWithKeys(items, [relation_type])
-    labelled_ids = [item['id'] for item in labelled_items]
+    labelled_ids = set(item['id'] for item in labelled_items)
+    allowed_ids = set(allowed_target_ids)
+    nodes = {item['id']: item for item in items}
 
     # For each item Si of the L1 labelled items most similar to H
-    S = [row for row in H['distances'] if row[1] in labelled_ids]
-    if (L1):
-        S = S[:L1]
-    for D1, Si_id in S:
-        Si = getNode(Si_id, labelled_items)
+    S = list(islice((row for row in H['distances'] if row[1] in labelled_ids), L1 or None))
+    for Si_rank, (D1, Si_id) in enumerate(S):
+        if prune and len(best) >= prune:
+            threshold = heapq.nsmallest(prune, best.values())[-1]
+            if D1 > threshold:
+                break
+
+        Si = nodes.get(Si_id)
         if Si is None:
             continue
 
         # For each item Ri related to Si
         R = Si[relation_type]
+        if max_relations and len(R) > max_relations:
+            # Bound the cost of hub items by only following their strongest relations
+            if relation_order == 'weight':
+                weights = Si[relation_type + '_weights']
+                if len(weights) != len(R):
+                    raise ValueError(f'Item {Si_id} has {len(R)} {relation_type} relations '
+                                     f'but {len(weights)} {relation_type}_weights')
+                R = [Ri_id for w, Ri_id in sorted(zip(weights, R), key=lambda x: -x[0])]
+            else:
+                if query_distances is None:
+                    query_distances = {id: d for d, id in H['distances']}
+                R = sorted(R, key=lambda id: query_distances.get(id, np.inf))
+            if stats is not None:
+                stats['capped'] = stats.get('capped', 0) + 1
+                stats['skipped'] = stats.get('skipped', 0) + len(R) - max_relations
+            R = R[:max_relations]
+
         for Ri_id in R:
-            Ri = getNode(Ri_id, items)
+            Ri = nodes.get(Ri_id)
             if Ri is None:
                 continue
 
             # Add to output the related node (if it is an allowed target)
             # The distance score is the distance from H to Si
-            if(Ri_id in allowed_target_ids):
+            if(Ri_id in allowed_ids):
                 match = {
                     'target_node': Ri,
                     'similar_node': Si,
                     'related_node': Ri,
-                    'distance': D1
+                    'distance': D1,
+                    'similar_rank': Si_rank,
+                    'target_rank': None
                 }
                 O.append(match)
+                if prune:
+                    best[Ri_id] = min(D1, best.get(Ri_id, np.inf))
 
             # For each item Ti of the L2 items most similar to Ri (that are allowed targets)
-            T = [Ti for Ti in Ri['distances'] if Ti[1] in allowed_target_ids]
-            if (L2):
-                T = T[:L2]
-            for D2, Ti_id in T:
-                Ti = getNode(Ti_id, items)
+            T = islice((Ti for Ti in Ri['distances'] if Ti[1] in allowed_ids), L2 or None)
+            for Ti_rank, (D2, Ti_id) in enumerate(T):
+                # Longer routes cannot change the top targets, but the first route to each
+                # target is kept as it decides the order of targets with tied scores
+                if D1 + D2 > threshold and Ti_id in best:
+                    continue
+
+                Ti = nodes.get(Ti_id)
                 if Ti is None:
                     continue
 
@@ -89,37 +288,109 @@ def infer(max_similar, max_related, query, items, allowed_target_ids, relation_t
                     'target_node': Ti,
                     'similar_node': Si,
                     'related_node': Ri,
-                    'distance': D1 + D2
+                    'distance': D1 + D2,
+                    'similar_rank': Si_rank,
+                    'target_rank': Ti_rank
                 }
                 O.append(match)
+                if prune:
+                    best[Ti_id] = min(D1 + D2, best.get(Ti_id, np.inf))
+
+    return O
+
 
-    return _scoreRoutes(O, mode)
+def rankRoutes(routes, mode, max_similar=None, max_related=None, top_k=None):
+    """
+    Ranks targets as infer would from routes found by findRoutes.
+    If max_similar or max_related are set, only the routes that would be found
+    with those smaller values of L1 and L2 are used.
+    """
+    return _scoreRoutes(_filterRoutes(routes, max_similar, max_related), mode, top_k)
+
+
+def scoreTargets(routes, mode, allowed_target_ids, max_similar=None, max_related=None):
+    """
+    Scores targets as rankRoutes would, without building or sorting the ranked output.
+    Returns an array of scores aligned to allowed_target_ids (nan if a target is unreachable)
+    and an array of the order in which targets were first reached, used to break ties.
+    Use targetRank to find the rank of a target. Repeated ids are only scored at their first position.
+    """
+    routes = _filterRoutes(routes, max_similar, max_related)
+    index = {}
+    for i, id in enumerate(allowed_target_ids):
+        index.setdefault(id, i)
 
+    targets = np.array([index[r['target_node']['id']] for r in routes], dtype=int)
+    distances = np.array([r['distance'] for r in routes], dtype=float)
 
-def _scoreRoutes(collection, mode):
+    discovered = np.full(len(allowed_target_ids), len(routes))
+    np.minimum.at(discovered, targets, np.arange(len(routes)))
+
+    scores = np.full(len(allowed_target_ids), np.nan)
+    if len(routes):
+        reached, s = _targetScores(targets, distances, mode)
+        scores[reached] = s
+    return scores, discovered
+
+
+def targetRank(scores, discovered, i):
+    """
+    Returns the rank (0 is best) that target i of scoreTargets would have in the output of infer,
+    or None if it is unreachable. Ties are broken by the order targets were first reached, as in infer.
+    Use targetRanks to rank many targets, as each call counts over all targets.
+    """
+    score = scores[i]
+    if np.isnan(score):
+        return None
+    return int(np.count_nonzero(scores > score) +
+               np.count_nonzero((scores == score) & (discovered < discovered[i])))
+
+
+def targetRanks(scores, discovered):
+    """
+    Returns the rank (0 is best) of every target of scoreTargets, as targetRank would, in one pass
+    Unreachable targets are ranked after all reachable targets
+    """
+    order = np.lexsort((discovered, -scores, np.isnan(scores)))
+    ranks = np.empty(len(scores), dtype=int)
+    ranks[order] = np.arange(len(scores))
+    return ranks
+
+
+def _filterRoutes(routes, max_similar, max_related):
+    """
+    Returns the routes from findRoutes that would be found with max_similar and max_related
+    """
+    return [r for r in routes
+            if (not max_similar or r['similar_rank'] < max_similar)
+            and (not max_related or r['target_rank'] is None or r['target_rank'] < max_related)]
+
+
+def _scoreRoutes(collection, mode, top_k=None):
     """
     Converts a collection of identified routes into an order list of scored targets
+    If top_k is set, only the top_k highest scoring targets are returned
     """
-    outputs = []
-    rangeFit = True  # Most algorithms need fitting to 0-1
+    targets = {}
 
-    # Group routes by target node
+    # Group routes by target node, in the order targets were first reached
     for value in collection:
 
         tID = value['target_node']['id']
 
-        target = next(
-            (item for item in outputs if item['target_id'] == tID), None)
-
-        if not target:
+        if tID not in targets:
             # Add target entry if this is it's first route
-            outputs.append({
+            targets[tID] = {
                 'target_id': tID,
                 'routes': [value]
-            })
+            }
         else:
             # Otherwise add it to the routes list for the target
-            target['routes'].append(value)
+            targets[tID]['routes'].append(value)
+
+    outputs = list(targets.values())
+    if not outputs:
+        return outputs
 
     for target in outputs:
         # Arrange routes shortest first
@@ -129,160 +400,377 @@ def _scoreRoutes(collection, mode):
         target['distance'] = target['routes'][0]['distance']
 
     # Determine score for each target
-    for target in outputs:
+    index = {tID: i for i, tID in enumerate(targets)}
+    reached, scores = _targetScores(
+        np.array([index[value['target_node']['id']] for value in collection], dtype=int),
+        np.array([value['distance'] for value in collection], dtype=float),
+        mode)
+    for i, score in zip(reached, scores):
+        outputs[i]['score'] = score
+
+    # Return results in descending order of score
+    if top_k:
+        # Bounded heap selection, equivalent to sorting then truncating
+        return heapq.nlargest(top_k, outputs, key=lambda k: k['score'])
+    return sorted(outputs, key=lambda k: -k['score'])
+
+
+def _targetScores(targets, distances, mode):
+    """
+    Scores targets with scoring algorithm mode from the routes found to them,
+    given as the index of the target and the distance of each route, in the order routes were found
+    Returns the index of each target reached and its score
+    """
 
-        if mode == 'a':
-            # Sort by shortest distance (not range fitted)
-            target['score'] = 1 - target['distance']/2
-            rangeFit = False
-
-        elif mode == 'a*':
-            # Sort by shortest distance
-            target['score'] = 1 - target['distance']/2
-
-        elif mode == 'b':
-            # Sort by number of routes to the target, followed by shortest distance
-            target['score'] = len(target['routes']) - target['distance']/2
-
-        elif mode == 'c':
-            # Sort by most similarity * number of routes
-            target['score'] = (1-target['distance']/2) * len(target['routes'])
-
-        elif mode == 'd':
-            # Sort by sum similarity over all routes
-            target['score'] = sum(1 - r['distance'] for r in target['routes'])
-
-        elif mode == 'e':
-            # Sort by most similarity + second most similarity/2
-            s = 1 - target['distance']/2
-            if (len(target['routes']) > 1):
-                s += (1 - target['routes'][1]['distance']/2)/2
-            target['score'] = s
-
-        elif mode == 'f':
-            # Sort by sum over all routes of similarity/position
-            s = 0
-            for i in range(len(target['routes'])):
-                r = target['routes'][i]
-                j = i+1
-                d = r['distance']/2
-                s += (1 - d) / j
-            target['score'] = s
-
-        elif mode == 'g':
-            # Sort by sum over all routes of similarity/position^2
-            s = 0
-            for i in range(len(target['routes'])):
-                r = target['routes'][i]
-                j = i+1
-                d = r['distance']/2
-                s += (1 - d) / (j*j)
-            target['score'] = s
-
-        elif mode == 'h':
-            # Sort by sum over all routes of similarity/position^3
-            s = 0
-            for i in range(len(target['routes'])):
-                r = target['routes'][i]
-                j = i+1
-                d = r['distance']/2
-                s += (1 - d) / (j*j*j)
-            target['score'] = s
-
-        elif mode == 'i':
-            # Sort by sum over all routes of 1-distance^2
-            s = 0
-            for i in range(len(target['routes'])):
-                r = target['routes'][i]
-                d = r['distance']/2
-                s += (1 - d*d)
-            target['score'] = s
-
-        elif mode == 'j':
-            # Sort by sum over all routes of 1-distance^3
-            s = 0
-            for i in range(len(target['routes'])):
-                r = target['routes'][i]
-                d = r['distance']/2
-                s += (1 - d*d*d)
-            target['score'] = s
-
-        elif mode == 'k':
-            # Sort by geometric series weighted sum similarity
-            s = 0
-            den = 2
-            for r in target['routes']:
-                s += (1 - r['distance']/2) / den
-                den = den*2
-            target['score'] = s
-
-        elif mode == 'l':
-            # Sort by telescopic weighted sum similarity
-            s = 0
-            for i in range(len(target['routes'])):
-                r = target['routes'][i]
-                n = i+1
-                routeScore = 1 - r['distance']/2
-                s += routeScore / (n*(n+1))
-            s = s/2
-            target['score'] = s
-
-        elif mode == 'm':
-            # Sort by sum over all routes of 1/(distance*position^3)
-            s = 0
-            for i in range(len(target['routes'])):
-                r = target['routes'][i]
-                j = i+1
-                d = r['distance']/2
-                s += 1 / (d*j*j*j)
-            target['score'] = s
-
-        elif mode == 'n':
-            # Sort by sum over all routes of 1/distance^2
-            s = 0
-            for i in range(len(target['routes'])):
-                r = target['routes'][i]
-                j = i+1
-                d = r['distance']/2
-                s += 1 / (d*d)
-            target['score'] = s
-
-        elif mode == 'o':
-            # Sort by sum over all routes of 1/(distance*position)
-            s = 0
-            for i in range(len(target['routes'])):
-                r = target['routes'][i]
-                j = i+1
-                d = r['distance']/2
-                s += 1 / (d*j)
-            target['score'] = s
-
-        elif mode == 'p':
-            # Sort by sum over all routes of 1/(distance*position^2)
-            s = 0
-            for i in range(len(target['routes'])):
-                r = target['routes'][i]
-                j = i+1
-                d = r['distance']/2
-                s += 1 / (d*j*j)
-            target['score'] = s
-
-        elif mode == 'q':
-            # Sort by sum over all routes of 1/distance
-            target['score'] = sum(
-                1/(r['distance']/2) for r in target['routes'])
+    # Arrange routes shortest first within each target (stable, so equal routes keep their order)
+    order = np.lexsort((distances, targets))
+    targets, distances = targets[order], distances[order]
+    starts = np.flatnonzero(np.r_[True, targets[1:] != targets[:-1]])
+    counts = np.diff(np.r_[starts, len(targets)])
+    group = np.repeat(np.arange(len(starts)), counts)
+    j = np.arange(len(targets)) - starts[group] + 1  # Position of each route
+    d = distances/2
+    shortest = distances[starts]
+    n = counts.astype(float)
+
+    def total(values):
+        # Sum over all routes of each target
+        return np.bincount(group, weights=values, minlength=len(starts))
+
+    rangeFit = True  # Most algorithms need fitting to 0-1
+
+    if mode == 'a':
+        # Sort by shortest distance (not range fitted)
+        s = 1 - shortest/2
+        rangeFit = False
+    elif mode == 'a*':
+        # Sort by shortest distance
+        s = 1 - shortest/2
+    elif mode == 'b':
+        # Sort by number of routes to the target, followed by shortest distance
+        s = n - shortest/2
+    elif mode == 'c':
+        # Sort by most similarity * number of routes
+        s = (1-shortest/2) * n
+    elif mode == 'd':
+        # Sort by sum similarity over all routes
+        s = total(1 - distances)
+    elif mode == 'e':
+        # Sort by most similarity + second most similarity/2
+        s = 1 - shortest/2
+        second = counts > 1
+        s[second] += (1 - distances[starts[second] + 1]/2)/2
+    elif mode == 'f':
+        # Sort by sum over all routes of similarity/position
+        s = total((1 - d) / j)
+    elif mode == 'g':
+        # Sort by sum over all routes of similarity/position^2
+        s = total((1 - d) / (j*j))
+    elif mode == 'h':
+        # Sort by sum over all routes of similarity/position^3
+        s = total((1 - d) / (j*j*j))
+    elif mode == 'i':
+        # Sort by sum over all routes of 1-distance^2
+        s = total(1 - d*d)
+    elif mode == 'j':
+        # Sort by sum over all routes of 1-distance^3
+        s = total(1 - d*d*d)
+    elif mode == 'k':
+        # Sort by geometric series weighted sum similarity
+        s = total((1 - distances/2) / 2.0**j)
+    elif mode == 'l':
+        # Sort by telescopic weighted sum similarity
+        s = total((1 - distances/2) / (j*(j+1))) / 2
+    elif mode == 'm':
+        # Sort by sum over all routes of 1/(distance*position^3)
+        s = total(1 / (d*j*j*j))
+    elif mode == 'n':
+        # Sort by sum over all routes of 1/distance^2
+        s = total(1 / (d*d))
+    elif mode == 'o':
+        # Sort by sum over all routes of 1/(distance*position)
+        s = total(1 / (d*j))
+    elif mode == 'p':
+        # Sort by sum over all routes of 1/(distance*position^2)
+        s = total(1 / (d*j*j))
+    elif mode == 'q':
+        # Sort by sum over all routes of 1/distance
+        s = total(1/(distances/2))
+    else:
+        raise ValueError(f'Unknown scoring mode {mode}')
 
     if(rangeFit):
         # Fit all scores to the range 0-1
-        scores = np.array([target['score'] for target in outputs])
         min_max_scaler = preprocessing.MinMaxScaler(feature_range=(0, 1))
-        scaled = min_max_scaler.fit_transform(scores[:, np.newaxis])
+        s = min_max_scaler.fit_transform(s[:, np.newaxis])[:, 0]
 
-        for i in range(0, len(outputs)):
-            outputs[i]['score'] = scaled[i][0]
+    return targets[starts], s
 
-    # Return results in descending order of score
-    return sorted(outputs, key=lambda k: -k['score'])
+
+def inferAll(max_similar, max_related, items, relation_type, mode, top_k=None):
+    """
+    Ranks targets for every item as the query in one vectorised pass using sparse matrix products.
+    Equivalent to calling infer for each item with all other items as allowed targets,
+    except that the query is left in the dataset, so it may appear as a similar or related node.
+    Ties are broken by the order infer first reaches each target. Scores may differ from infer by
+    rounding error, so targets with equal scores in exact arithmetic (mostly in mode d) may be ordered differently.
+    Only modes that depend on the route count and distance sums are supported (a, a*, b, c, d, i, j).
+    items should be dicts with the keys 'id' and 'distances', as for infer.
+    Returns a sparse matrix of scores with rows (queries) and columns (targets) in the order of items.
+    Stored entries are the reachable targets (explicit zeros are valid scores),
+    stored in descending order of score for each query.
+    If top_k is set, only the top_k highest scoring targets are kept for each query.
+    """
+
+    if mode not in ['a', 'a*', 'b', 'c', 'd', 'i', 'j']:
+        raise ValueError(f'Scoring mode {mode} is not supported for bulk inference')
+
+    L1 = max_similar
+    L2 = max_related
+    N = len(items)
+    index = {item['id']: i for i, item in enumerate(items)}
+    labelled_ids = set(item['id'] for item in itemsWithKeys(items, [relation_type]))
+
+    print("\nBUILDING SPARSE ROUTE MATRICES...")
+
+    # A[h, s] = distance from h to each of the L1 labelled items most similar to h
+    A = _neighbourMatrix(items, index, L1, labelled_ids)
+
+    # R[s, r] = 0 for each item r related to s (relations are given a distance of 0)
+    rows, cols = [], []
+    for i, item in enumerate(items):
+        related = [index[r] for r in item.get(relation_type) or [] if r in index]
+        rows.extend([i] * len(related))
+        cols.extend(related)
+    R = _csrFromArrays(np.array(rows, dtype=np.int64), np.array(cols, dtype=np.int64),
+                       np.zeros(len(rows)), (N, N))
+
+    # B[r, t] = distance from r to each of the L2 items most similar to r
+    # plus r itself at a distance of 0 for the direct route to the related node
+    B = _neighbourMatrix(items, index, L2, None, include_self=True)
+
+    # The query is never an allowed target, so where the query h is one of the L2 items most
+    # similar to r (Q[h, r]), the next most similar item C[r, t] takes its place
+    if L2:
+        C = _neighbourMatrix(items, index, 1, None, skip=L2)
+        Q = _neighbourMatrix(items, index, L2, None).T.tocsr()
+    else:
+        C = sparse.csr_matrix((N, N))
+        Q = sparse.csr_matrix((N, N))
+
+    print("CALCULATING SCORES...")
+
+    def paths(j, k):
+        # Sum over all routes of D1^j * D2^k from each query to each target
+        AR = _power(A, j) @ _power(R, 0)
+        return AR @ _power(B, k) + _mask(AR, Q) @ _power(C, k)
+
+    # Number of routes from each query to each target
+    count = paths(0, 0).tocsr()
+    count.setdiag(0)  # Never recommend the query to itself
+    count.eliminate_zeros()
+    count.sort_indices()
+    rows = np.repeat(np.arange(N), np.diff(count.indptr))
+    cols = count.indices
+    n = count.data
+
+    def moment(k):
+        # Sum over all routes of distance^k, by binomial expansion of (D1 + D2)^k
+        total = sparse.csr_matrix((N, N))
+        for j in range(k + 1):
+            total = total + _binomial(k, j) * paths(j, k - j)
+        return np.asarray(total[rows, cols]).ravel()
+
+    def shortest(A, R, B, C):
+        # Shortest route from each query to each target, by min-plus products
+        AR = _minPlus(A, R)
+        return np.minimum(_lookup(_minPlus(AR, B), rows, cols),
+                          _lookup(_minPlus(_mask(AR, Q), C), rows, cols))
+
+    # infer reaches targets in order of the rank of the similar node, then the position of
+    # the related node in its relation list, then the rank of the target (0 for the related node).
+    # Each route is numbered in that order, so the first route to each target has the lowest number
+    K2 = max(np.diff(B.indptr).max(initial=0), L2 or 0) + 2
+    K1 = K2 * max(np.diff(R.indptr).max(initial=0), 1)
+    C_order = _positions(C, 1)
+    C_order.data += (L2 or 0) + 1  # C replaces the query after the L2 items most similar to r
+    discovered = shortest(_positions(A, K1), _positions(R, K2), _positions(B, 1), C_order)
+
+    rangeFit = True  # Most algorithms need fitting to 0-1
+
+    if mode == 'a':
+        scores = 1 - shortest(A, R, B, C)/2
+        rangeFit = False
+    elif mode == 'a*':
+        scores = 1 - shortest(A, R, B, C)/2
+    elif mode == 'b':
+        scores = n - shortest(A, R, B, C)/2
+    elif mode == 'c':
+        scores = (1 - shortest(A, R, B, C)/2) * n
+    elif mode == 'd':
+        scores = n - moment(1)
+    elif mode == 'i':
+        scores = n - moment(2)/4
+    elif mode == 'j':
+        scores = n - moment(3)/8
+
+    scores = scores.astype(float)
+    if rangeFit and len(scores):
+        # Fit each query's scores to the range 0-1
+        nonempty = np.diff(count.indptr) > 0
+        starts = count.indptr[:-1][nonempty]
+        lows = np.repeat(np.minimum.reduceat(scores, starts), np.diff(count.indptr)[nonempty])
+        highs = np.repeat(np.maximum.reduceat(scores, starts), np.diff(count.indptr)[nonempty])
+        spans = highs - lows
+        spans[spans == 0] = 1
+        scores = (scores - lows) / spans
+
+    # Order each query's targets by descending score, then the order they were first reached
+    order = np.lexsort((discovered, -scores, rows))
+    rows, cols, scores = rows[order], cols[order], scores[order]
+    if top_k:
+        starts = np.repeat(count.indptr[:-1], np.diff(count.indptr))
+        keep = np.arange(len(rows)) - starts < top_k
+        rows, cols, scores = rows[keep], cols[keep], scores[keep]
+
+    return _csrFromArrays(rows, cols, scores, (N, N))
+
+
+def _neighbourMatrix(items, index, limit, allowed_ids, include_self=False, skip=0):
+    """
+    Builds a sparse matrix with the distances from each item to its limit most similar items
+    If allowed_ids is set, only items with those ids are counted as neighbours
+    If skip is set, the skip most similar items are passed over
+    """
+    rows, cols, data = [], [], []
+    for i, item in enumerate(items):
+        if include_self:
+            rows.append(i)
+            cols.append(i)
+            data.append(0)
+        neighbours = [row for row in item['distances']
+                      if row[1] in index and (allowed_ids is None or row[1] in allowed_ids)]
+        if (limit):
+            neighbours = neighbours[skip:skip+limit]
+        else:
+            neighbours = neighbours[skip:]
+        for d, id in neighbours:
+            rows.append(i)
+            cols.append(index[id])
+            data.append(d)
+    shape = (len(items), len(items))
+    return _csrFromArrays(np.array(rows, dtype=np.int64), np.array(cols, dtype=np.int64),
+                          np.array(data, dtype=float), shape)
+
+
+def _csrFromArrays(rows, cols, data, shape):
+    """
+    Builds a CSR matrix from coordinates which keeps explicit zeros
+    The order of entries within each row is kept and there must be no duplicate coordinates
+    """
+    order = np.argsort(rows, kind='stable')
+    indptr = np.concatenate([[0], np.cumsum(np.bincount(rows, minlength=shape[0]))])
+    return sparse.csr_matrix((data[order], cols[order], indptr), shape=shape)
+
+
+def _power(M, k):
+    """
+    Returns a copy of sparse matrix M with each stored value raised to the power k
+    Stored zeros become ones for k = 0, so the result can be used to count paths
+    """
+    return sparse.csr_matrix((M.data ** k, M.indices, M.indptr), shape=M.shape)
+
+
+def _positions(M, scale):
+    """
+    Returns a copy of sparse matrix M with each stored value replaced by
+    its position within its row multiplied by scale
+    """
+    starts = np.repeat(M.indptr[:-1], np.diff(M.indptr))
+    positions = (np.arange(M.nnz) - starts) * float(scale)
+    return sparse.csr_matrix((positions, M.indices, M.indptr), shape=M.shape)
+
+
+def _mask(X, Q):
+    """
+    Returns the stored entries of sparse matrix X where sparse matrix Q also has a stored entry
+    Stored zeros are kept, as they are valid distances
+    """
+    X = X.tocsr()
+    X_rows = np.repeat(np.arange(X.shape[0]), np.diff(X.indptr))
+    Q_rows = np.repeat(np.arange(Q.shape[0]), np.diff(Q.indptr))
+    keep = np.isin(X_rows * X.shape[1] + X.indices, Q_rows * Q.shape[1] + Q.indices)
+    return _csrFromArrays(X_rows[keep], X.indices[keep], X.data[keep], X.shape)
+
+
+def _lookup(M, rows, cols):
+    """
+    Returns the values stored in sparse matrix M at each (rows, cols), or inf where none is stored
+    M must have sorted indices and no duplicate coordinates
+    """
+    values = np.full(len(rows), np.inf)
+    if not M.nnz:
+        return values
+    M_rows = np.repeat(np.arange(M.shape[0]), np.diff(M.indptr))
+    M_keys = M_rows * M.shape[1] + M.indices
+    keys = rows * M.shape[1] + cols
+    found = np.minimum(np.searchsorted(M_keys, keys), len(M_keys) - 1)
+    hit = M_keys[found] == keys
+    values[hit] = M.data[found[hit]]
+    return values
+
+
+def _binomial(n, k):
+    """
+    Returns the binomial coefficient n choose k
+    """
+    c = 1
+    for i in range(k):
+        c = c * (n - i) // (i + 1)
+    return c
+
+
+def _minPlus(X, Y):
+    """
+    Min-plus product of sparse matrices, out[i, j] = min over k of X[i, k] + Y[k, j]
+    Stored zeros are treated as distances, missing entries as unreachable
+    """
+    X_rows = np.repeat(np.arange(X.shape[0]), np.diff(X.indptr))
+    counts = np.diff(Y.indptr)[X.indices]
+    total = counts.sum()
+
+    # Join each stored X[i, k] with every stored Y[k, j]
+    offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+    positions = np.repeat(Y.indptr[:-1][X.indices], counts) + offsets
+    rows = np.repeat(X_rows, counts)
+    cols = Y.indices[positions]
+    values = np.repeat(X.data, counts) + Y.data[positions]
+
+    # Reduce by taking the minimum for each (i, j)
+    keys = rows * Y.shape[1] + cols
+    unique, inverse = np.unique(keys, return_inverse=True)
+    minimums = np.full(len(unique), np.inf)
+    np.minimum.at(minimums, inverse, values)
+
+    return _csrFromArrays(unique // Y.shape[1], unique % Y.shape[1], minimums,
+                          (X.shape[0], Y.shape[1]))
+
+
+def relationDegrees(items, relation_type):
+    """
+    Returns statistics of the number of relations per labelled item,
+    which can be used to choose max_relations for infer
+    """
+    degrees = np.array([len(item[relation_type]) for item in itemsWithKeys(items, [relation_type])])
+    if not len(degrees):
+        return {'labelled': 0}
+    return {
+        'labelled': len(degrees),
+        'mean': float(np.mean(degrees)),
+        'median': float(np.median(degrees)),
+        'p95': float(np.percentile(degrees, 95)),
+        'max': int(np.max(degrees))
+    }
 
 
 def getNode(id, items):
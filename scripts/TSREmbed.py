@@ -0,0 +1,189 @@
+"""
+This script adds description embeddings to a dataset so it can be used by the other scripts
+without precomputed embeddings. The default provider is fully local and CPU only,
+using hashed n-gram TF-IDF followed by truncated SVD.
+Embeddings are cached by description hash, so when a dataset is refreshed
+only new or changed descriptions are embedded.
+"""
+import argparse
+import hashlib
+import os.path
+import pickle
+import numpy as np
+from sklearn.feature_extraction.text import HashingVectorizer, TfidfTransformer
+from sklearn.decomposition import TruncatedSVD
+from sklearn.pipeline import make_pipeline
+import util
+
+
+class TFIDFProvider:
+    """
+    Embeds descriptions using hashed word n-gram TF-IDF reduced by truncated SVD
+    The model is fitted on the first descriptions it sees and then kept,
+    so embeddings of unchanged descriptions remain valid
+    """
+
+    def __init__(self, dimensions=128, ngrams=2, features=2**14):
+        self.dimensions = dimensions
+        self.ngrams = ngrams
+        self.features = features
+        self.model = None
+
+    def config(self):
+        """
+        Returns the settings that determine the embeddings, to check a cache was made with them
+        """
+        return {'provider': 'tfidf', 'dimensions': self.dimensions,
+                'ngrams': self.ngrams, 'features': self.features}
+
+    def fit(self, descriptions):
+        """
+        Fits the model to a list of descriptions
+        """
+        print(f"\nFITTING TF-IDF MODEL TO {len(descriptions)} DESCRIPTIONS...")
+        self.model = make_pipeline(
+            HashingVectorizer(ngram_range=(1, self.ngrams), n_features=self.features,
+                              alternate_sign=False, norm=None),
+            TfidfTransformer(sublinear_tf=True),
+            TruncatedSVD(min(self.dimensions, len(descriptions) - 1), random_state=0)
+        )
+        self.model.fit(descriptions)
+
+        # The SVD components dominate the size of the cache file
+        svd = self.model.steps[-1][1]
+        svd.components_ = svd.components_.astype(np.float32)
+
+    def embed(self, descriptions):
+        """
+        Returns an array with one embedding row per description
+        """
+        return self.model.transform(descriptions)
+
+
+PROVIDERS = {
+    'tfidf': TFIDFProvider
+}
+
+
+def main():
+
+    # Get inputs
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input", "-i", "--in",
+                        help="Path to JSON file containing items with descriptions")
+    parser.add_argument("--out", "-o", "--output",
+                        help="Path for JSON file to output items with embeddings")
+    parser.add_argument("--cache", "-c",
+                        help="Path of the embedding cache file. Created if it does not exist")
+    parser.add_argument("--provider", choices=list(PROVIDERS), default='tfidf',
+                        help="Embedding provider")
+    parser.add_argument("--batch", "-b", type=int, default=1000,
+                        help="Number of descriptions to embed at once")
+    parser.add_argument("--refit", action='store_true',
+                        help="Refit the embedding model to this dataset, discarding all cached embeddings")
+
+    args = parser.parse_args()
+
+    inPath = args.input or input(
+        "\nENTER PATH OF INPUT FILE:\n")
+
+    outPath = args.out or input(
+        "\nENTER PATH OF OUTPUT FILE:\n")
+
+    cachePath = args.cache or outPath + '.cache'
+
+    items = util.readJSONFile(inPath)
+
+    provider = PROVIDERS[args.provider]()
+    cache = None if args.refit else readCache(cachePath, provider)
+    if cache is None:
+        provider.fit([item['description'] for item in items])
+        cache = {'provider': provider, 'embeddings': {}}
+
+    embedItems(items, cache, args.batch)
+
+    writeCache(cachePath, cache)
+    util.writeJSONFile(outPath, items)
+
+
+def embedItems(items, cache, batch=1000):
+    """
+    Adds an embedding of its description to each item
+    Only descriptions missing from cache are embedded, in batches, and are then added to it
+    """
+    provider = cache['provider']
+    embeddings = cache['embeddings']
+
+    keys = [descriptionHash(item['description']) for item in items]
+    missing = {}
+    for key, item in zip(keys, items):
+        if key not in embeddings:
+            missing[key] = item['description']
+    cached = len([key for key in keys if key in embeddings])
+    print(f"\nFOUND {cached} CACHED EMBEDDINGS, EMBEDDING {len(missing)} NEW OR CHANGED DESCRIPTIONS...")
+
+    missing = list(missing.items())
+    for start in range(0, len(missing), batch):
+        chunk = missing[start:start+batch]
+        vectors = provider.embed([description for key, description in chunk])
+        for (key, description), vector in zip(chunk, vectors):
+            embeddings[key] = vector.astype(np.float32)
+
+    for key, item in zip(keys, items):
+        item['embedding'] = embeddings[key].tolist()
+
+    return items
+
+
+def descriptionHash(description):
+    """
+    Returns a key identifying the text of a description
+    """
+    return hashlib.sha1(description.encode('utf8')).hexdigest()
+
+
+def readCache(path, provider=None):
+    """
+    Returns the embedding cache at path, with its fitted model loaded into provider,
+    or None if it does not exist or was created by a provider with different settings
+    If provider is not set, it is rebuilt from the settings saved in the cache
+    """
+    if not os.path.isfile(path):
+        return None
+
+    print(f"\nREADING EMBEDDING CACHE: {path}")
+    with open(path, 'rb') as f:
+        saved = pickle.load(f)
+
+    if 'config' not in saved:
+        print("CACHE IS IN AN OLD FORMAT AND WILL BE REPLACED")
+        return None
+
+    if provider is None:
+        settings = dict(saved['config'])
+        provider = PROVIDERS[settings.pop('provider')](**settings)
+    elif saved['config'] != provider.config():
+        print("CACHE WAS CREATED WITH DIFFERENT SETTINGS AND WILL BE REPLACED")
+        return None
+
+    provider.model = saved['model']
+    return {'provider': provider, 'embeddings': saved['embeddings']}
+
+
+def writeCache(path, cache):
+    """
+    Saves the embedding cache, including the fitted model and settings of its provider, to path
+    Only the model is saved rather than the provider, so the cache can be read from other modules
+    """
+    print(f"\nSAVING EMBEDDING CACHE: {path}")
+    provider = cache['provider']
+    with open(path, 'wb') as f:
+        pickle.dump({
+            'config': provider.config(),
+            'model': provider.model,
+            'embeddings': cache['embeddings']
+        }, f)
+
+
+if __name__ == '__main__':
+    main()
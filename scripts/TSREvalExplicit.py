@@ -10,6 +10,9 @@ import argparse
 import sklearn.metrics as metrics
 import TSRCore as core
 import util
+import multiprocessing
+from functools import partial
+import traceback
 
 
 def main():
@@ -26,6 +29,16 @@ def main():
                         help="Name of negative relation label")
     parser.add_argument("--mode", "-m",
                         help="Scoring algorithm (a to q)")
+    parser.add_argument("--workers", "-w", type=int, default=1,
+                        help="Number of worker processes. Use 0 for one per CPU core")
+    parser.add_argument("--precision", choices=['float16', 'int8'],
+                        help="Quantise embeddings to reduce memory use. Full precision if not set")
+    parser.add_argument("--rerank", type=int, default=100,
+                        help="Number of nearest items to recalculate exactly when quantising embeddings")
+    parser.add_argument("--L1", type=int, nargs='+', default=[5],
+                        help="Number of similar labelled items to search. Multiple values are evaluated as a grid")
+    parser.add_argument("--L2", type=int, nargs='+', default=[10],
+                        help="Number of targets to search per related item. Multiple values are evaluated as a grid")
 
     args = parser.parse_args()
 
@@ -46,7 +59,7 @@ def main():
     items = util.readJSONFile(inPath)
 
     # Pre-calculate cosine distance for all items
-    items = core.distancesSemantic(items)
+    items = core.distancesSemantic(items, args.precision, args.rerank)
 
     # We can only evaluate labelled items
     labelled = core.itemsWithKeys(items, [relation_pos, relation_neg])
@@ -55,89 +68,55 @@ def main():
         return
 
     dsname = ntpath.basename(inPath)
-    r = evaluateItems(labelled, items, relation_pos,
-                      relation_neg, mode, dsname)
+    results = evaluateItems(labelled, items, relation_pos,
+                            relation_neg, mode, dsname, args.workers, args.L1, args.L2)
 
-    print('\n' + r['text'])
+    for r in results:
+        print('\n' + r['text'])
 
     if outPath:
-        util.writeCSV(outPath, [r], ['text', 'P@R', 'R@R'])
+        util.writeCSV(outPath, results, ['text', 'P@R', 'R@R'])
 
 
-def evaluateItems(labelled, items, relation_pos, relation_neg, mode, dsname):
+def evaluateItems(labelled, items, relation_pos, relation_neg, mode, dsname,
+                  workers=1, L1s=[5], L2s=[10]):
     """
     Determine the rank score of each label for each labelled item
     We can evaluate performance by the mean rank for the labels
+    Queries are evaluated in parallel if workers is not 1 (0 uses all CPU cores)
+    Returns one result for each combination of L1 in L1s and L2 in L2s
     """
-    L1 = 5
-    L2 = 10
-
-    all_scores = [] # Predicted scores
-    all_GT = [] # Ground Truth labels (0 or 1)
-    all_PR = [] # Predicted labels (0 or 1)
-
-    for selected in range(0, len(labelled)):
-
-        query = labelled[selected]
-
-        # Only rank items which the query has a known label for
-        tests_pos = query[relation_pos]
-        tests_neg = query[relation_neg]
-        allowed_target_ids = tests_pos + tests_neg
-
-        # Remove the query from the dataset
-        safe_items = items.copy()
-        safe_items.remove(query)
-
-        # Strip all labels from the query
-        safe_query = copy.deepcopy(query)
-        safe_query[relation_pos] = []
-
-        # Rank
-        ranked = core.infer(
-            max_similar=L1,
-            max_related=L2,
-            query=safe_query,
-            items=safe_items,
-            allowed_target_ids=allowed_target_ids,
-            relation_type=relation_pos,
-            mode=mode
-        )
-
-        threshold = len(tests_pos)  # Rank threshold for R-Precision
-        worstRank = len(allowed_target_ids) - 1 # Default if item not in results
-
-        ranked_ids = [item['target_id'] for item in ranked]
-
-        # Check ranks of positive labels
-        for id in tests_pos:
-
-            # Add to Ground Truth
-            all_GT.append(1)
-
-            # Record label based on rank threshold
-            rank = ranked_ids.index(id) if id in ranked_ids else worstRank
-            all_PR.append(1 if rank < threshold else 0)
-
-            # Record score
-            score = ranked[rank]['score'] if id in ranked_ids else 0
-            all_scores.append(score)
-
-        # Check ranks of negative labels
-        for id in tests_neg:
-
-            # Add to Ground Truth
-            all_GT.append(0)
-
-            # Record label based on rank threshold
-            rank = ranked_ids.index(id) if id in ranked_ids else worstRank
-            all_PR.append(1 if rank < threshold else 0)
-
-            # Record score
-            score = ranked[rank]['score'] if id in ranked_ids else 0
-            all_scores.append(score)
-
-        print(f'EVALUATED QUERY: {str(safe_query["id"]).ljust(5)}')
+    grid = [(L1, L2) for L1 in L1s for L2 in L2s]
+
+    runQuery = partial(doQuery,
+                       relation_pos=relation_pos,
+                       relation_neg=relation_neg,
+                       mode=mode,
+                       grid=grid)
+
+    if workers == 1:
+        _initWorker(items)
+        results = [runQuery(query) for query in labelled]
+    else:
+        # The dataset is passed once per worker rather than once per query
+        print('\nSPAWNING WORKER PROCESSES...')
+        with multiprocessing.Pool(workers or None, _initWorker, (items,)) as pool:
+            print('\nPROCESSING QUERIES...\n')
+            results = pool.map(runQuery, labelled)
+
+    return [summariseResults([result[g] for result in results], len(labelled),
+                             relation_pos, relation_neg, mode, dsname, L1, L2)
+            for g, (L1, L2) in enumerate(grid)]
+
+
+def summariseResults(results, labelled_count, relation_pos, relation_neg, mode, dsname, L1, L2):
+    """
+    Calculates R-Precision and error values from the ground truth labels,
+    predicted labels and scores of each query
+    """
+    all_GT = np.concatenate([GT for GT, PR, scores in results]) # Ground Truth labels (0 or 1)
+    all_PR = np.concatenate([PR for GT, PR, scores in results]) # Predicted labels (0 or 1)
+    all_scores = np.concatenate([scores for GT, PR, scores in results]) # Predicted scores
 
     np.set_printoptions(precision=4)
 
@@ -146,9 +125,9 @@ def evaluateItems(labelled, items, relation_pos, relation_neg, mode, dsname):
         'dataset': dsname,
         'positive_label_name': relation_pos,
         'negative_label_name': relation_neg,
-        'labelled_items_count': len(labelled),
-        'positive_label_count': all_GT.count(1),
-        'negative_label_count': all_GT.count(0),
+        'labelled_items_count': labelled_count,
+        'positive_label_count': int(np.sum(all_GT == 1)),
+        'negative_label_count': int(np.sum(all_GT == 0)),
         'scoring_mode': mode,
         'L1': L1,
         'L2': L2
@@ -192,5 +171,84 @@ AND {r["negative_label_count"]} NEGATIVE "{r["negative_label_name"]}" LABELS:'
     return r
 
 
+_items = None  # Dataset shared by all queries evaluated in this process
+
+
+def _initWorker(items):
+    global _items
+    _items = items
+
+
+def doQuery(query, relation_pos, relation_neg, mode, grid):
+    """
+    Ranks the labelled targets of a single query with it left out of the dataset
+    Routes are found once for the largest L1 and L2 in grid, then ranked for each (L1, L2)
+    Returns arrays of the ground truth labels, predicted labels and scores for each target,
+    for each (L1, L2) in grid
+    """
+    try:
+
+        # Only rank items which the query has a known label for
+        tests_pos = query[relation_pos]
+        tests_neg = query[relation_neg]
+        allowed_target_ids = tests_pos + tests_neg
+
+        # Remove the query from the dataset
+        safe_items = [item for item in _items if item['id'] != query['id']]
+
+        # Strip all labels from the query
+        safe_query = copy.deepcopy(query)
+        safe_query[relation_pos] = []
+
+        # Find routes for the largest L1 and L2 (0 is unlimited)
+        L1s = [L1 for L1, L2 in grid]
+        L2s = [L2 for L1, L2 in grid]
+        routes = core.findRoutes(
+            max_similar=0 if 0 in L1s else max(L1s),
+            max_related=0 if 0 in L2s else max(L2s),
+            query=safe_query,
+            items=safe_items,
+            allowed_target_ids=allowed_target_ids,
+            relation_type=relation_pos
+        )
+
+        threshold = len(tests_pos)  # Rank threshold for R-Precision
+        worstRank = len(allowed_target_ids) - 1 # Default if item not in results
+
+        # Ground Truth is 1 for positive labels and 0 for negative labels
+        GT = np.array([1] * len(tests_pos) + [0] * len(tests_neg))
+
+        # Targets may have both labels, so use the first position of each id
+        first = {}
+        for i, id in enumerate(allowed_target_ids):
+            first.setdefault(id, i)
+        positions = [first[id] for id in allowed_target_ids]
+
+        results = []
+        for L1, L2 in grid:
+
+            # Score
+            scores, discovered = core.scoreTargets(
+                routes, mode, allowed_target_ids, L1, L2)
+
+            # Record label based on rank threshold
+            target_ranks = core.targetRanks(scores, discovered)[positions]
+            target_ranks[np.isnan(scores[positions])] = worstRank
+            PR = (target_ranks < threshold).astype(int)
+
+            # Record score (0 if not in results)
+            scores = np.nan_to_num(scores[positions], nan=0)
+
+            results.append((GT, PR, scores))
+
+        print(f'EVALUATED QUERY: {str(safe_query["id"]).ljust(5)}')
+
+        return results
+
+    except:
+        traceback.print_exc()
+        raise
+
+
 if __name__ == '__main__':
     main()
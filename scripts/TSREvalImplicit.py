@@ -15,6 +15,8 @@ import util
 import multiprocessing
 from functools import partial
 import traceback
+import json
+import os.path
 
 
 def main():
@@ -31,9 +33,33 @@ def main():
                         help="Name of positive relation label")
     parser.add_argument("--mode", "-m",
                         help="Scoring algorithm (a to q)")
+    parser.add_argument("--precision", choices=['float16', 'int8'],
+                        help="Quantise embeddings to reduce memory use. Full precision if not set")
+    parser.add_argument("--rerank", type=int, default=100,
+                        help="Number of nearest items to recalculate exactly when quantising embeddings")
+    parser.add_argument("--shard",
+                        help="Evaluate only shard i of n, given as i/n (e.g. 0/4). Requires --partial")
+    parser.add_argument("--partial",
+                        help="Path for file to append each test case result to. Cases already in the file are skipped")
+    parser.add_argument("--seed", type=int,
+                        help="Random seed for generating test cases. Defaults to 0 if --shard or --partial is set")
+    parser.add_argument("--merge", nargs='+',
+                        help="Paths of partial results files to combine instead of evaluating")
+    parser.add_argument("--L1", type=int, nargs='+', default=[5],
+                        help="Number of similar labelled items to search. Multiple values are evaluated as a grid")
+    parser.add_argument("--L2", type=int, nargs='+', default=[10],
+                        help="Number of targets to search per related item. Multiple values are evaluated as a grid")
 
     args = parser.parse_args()
 
+    if args.merge:
+        results = mergePartials(args.merge)
+        for r in results:
+            print('\n' + r['text'])
+        if args.out:
+            util.writeCSV(args.out, results, ['text', 'positive_label_ranks'])
+        return
+
     inPath = args.input or input(
         "\nENTER PATH OF INPUT FILE:\n")
 
@@ -48,10 +74,26 @@ def main():
 
     outPath = args.out
 
+    shard = (0, 1)
+    if args.shard:
+        try:
+            shard = tuple(int(n) for n in args.shard.split('/'))
+        except ValueError:
+            shard = ()
+        if len(shard) != 2 or not 0 <= shard[0] < shard[1]:
+            parser.error(f'--shard must be i/n with 0 <= i < n, not {args.shard}')
+        if not args.partial:
+            parser.error('--shard requires --partial, so the shard can be combined with --merge')
+
+    # Shards and resumed runs must generate the same test cases
+    seed = args.seed
+    if seed is None and (args.shard or args.partial):
+        seed = 0
+
     items = util.readJSONFile(inPath)
 
     # Pre-calculate cosine distance for all items
-    items = core.distancesSemantic(items)
+    items = core.distancesSemantic(items, args.precision, args.rerank)
 
     # We can only evaluate labelled items
     labelled = core.itemsWithKeys(items, [relation_pos])
@@ -60,22 +102,46 @@ def main():
         return
 
     dsname = ntpath.basename(inPath)
-    r = evaluateItems(labelled, items, relation_pos, mode, dsname, attempts)
+    results = evaluateItems(labelled, items, relation_pos, mode, dsname, attempts,
+                            shard=shard, partialPath=args.partial, seed=seed,
+                            L1s=args.L1, L2s=args.L2)
 
-    print('\n' + r['text'])
+    for r in results:
+        print('\n' + r['text'])
 
     if outPath:
-        util.writeCSV(outPath, [r], ['text', 'positive_label_ranks'])
+        util.writeCSV(outPath, results, ['text', 'positive_label_ranks'])
 
 
 def evaluateItems(labelled, items, relation_pos, mode, dsname, attempts,
-                  poolsize=101):
+                  poolsize=101, shard=(0, 1), partialPath=None, seed=None,
+                  L1s=[5], L2s=[10]):
     """
     Determine the rank score of each label for each labelled item
     We can evaluate performance by the mean rank for the labels
+    shard (i, n) evaluates only every nth test case, starting from the ith
+    If partialPath is set, each result is appended to that file as it completes
+    and test cases already in the file are not repeated
+    Returns one result for each combination of L1 in L1s and L2 in L2s
     """
-    L1 = 5
-    L2 = 10
+    grid = [[L1, L2] for L1 in L1s for L2 in L2s]
+    shard_index, shard_count = shard
+    if not 0 <= shard_index < shard_count:
+        raise ValueError(f'Invalid shard {shard_index} of {shard_count}')
+
+    config = {
+        'dataset': dsname,
+        'positive_label_name': relation_pos,
+        'scoring_mode': mode,
+        'grid': grid,
+        'evaluation_repeat_count': attempts,
+        'poolsize': poolsize,
+        'seed': seed,
+        'shard_count': shard_count
+    }
+
+    if seed is not None:
+        np.random.seed(seed)
 
     # Genrate common framework test scenarios
     # 100 randomly chosen unknowns with 1 known positive mixed in
@@ -96,32 +162,73 @@ def evaluateItems(labelled, items, relation_pos, mode, dsname, attempts,
                 np.random.shuffle(target_ids)
 
                 cases.append({
+                    "case": len(cases),
                     "query": labelled_item,
                     "pos_id": pos,
                     "target_ids": target_ids,
                     "attempt": i
                 })
 
+    # Keep only the cases in this shard, recording the total so merged shards can be checked
+    config['case_count'] = len(cases)
+    cases = [case for case in cases if case["case"] % shard_count == shard_index]
+
+    # Skip cases completed by a previous run
+    results = readPartial(partialPath, config) if partialPath else []
+    completed = set(result['case'] for result in results)
+    todo = [case for case in cases if case["case"] not in completed]
+    if shard_count > 1 or completed:
+        print(f'\nSHARD {shard_index}/{shard_count}: {len(cases)} TEST CASES, {len(cases) - len(todo)} ALREADY COMPLETE')
+
     # Run test cases in parallel
     runTest = partial(doCase,
-                      items=items,
                       relation_pos=relation_pos,
                       mode=mode,
-                      L1=L1,
-                      L2=L2,
+                      grid=grid,
                       poolsize=poolsize)
     print('\nSPAWNING WORKER PROCESSES...')
-    with multiprocessing.Pool() as pool:
+    # The dataset is passed once per worker rather than once per test case
+    with multiprocessing.Pool(None, _initWorker, (items,)) as pool:
         print('\nPROCESSING TEST CASES...\n')
-        results = pool.map(runTest, cases)
+        if partialPath:
+            # Save each result as soon as it completes
+            with open(partialPath, 'a+') as f:
+                if not f.tell():
+                    f.write(json.dumps({'config': config}) + '\n')
+                else:
+                    # Terminate any line left incomplete by an interrupted run
+                    f.seek(f.tell() - 1)
+                    if f.read(1) != '\n':
+                        f.write('\n')
+                for result in pool.imap_unordered(runTest, todo):
+                    f.write(json.dumps(result) + '\n')
+                    f.flush()
+                    results.append(result)
+        else:
+            results += pool.map(runTest, todo)
     print('\nALL TEST CASES COMPLETE\n')
 
+    return [summariseResults(results, config, g) for g in range(len(grid))]
+
+
+def summariseResults(results, config, g=0):
+    """
+    Calculates hit rates and rank statistics from a list of test case results
+    config must contain the evaluation settings used to produce the results
+    g is the index of the (L1, L2) combination in the grid to use the ranks of
+    """
+    L1, L2 = config['grid'][g]
+    results = sorted(results, key=lambda result: result['case'])
+    attempts = config['evaluation_repeat_count']
+    poolsize = config['poolsize']
+
     # Unpack results
-    all_pos_ranks = [rank for id, rank in results]
+    all_pos_ranks = [result['ranks'][g] for result in results]
 
     # Group results per target
     per_pos_ranks = {}
-    for id, rank in results:
+    for result in results:
+        id, rank = result['pos_id'], result['ranks'][g]
         if id in per_pos_ranks:
             per_pos_ranks[id].append(rank)
         else:
@@ -129,25 +236,29 @@ def evaluateItems(labelled, items, relation_pos, mode, dsname, attempts,
 
     r = {
         'text': '',
-        'dataset': dsname,
-        'positive_label_name': relation_pos,
-        'labelled_items_count': len(labelled),
+        'dataset': config['dataset'],
+        'positive_label_name': config['positive_label_name'],
+        'labelled_items_count': len(set(result['query_id'] for result in results)),
         'positive_label_count': int(len(all_pos_ranks)/attempts),
         'evaluation_repeat_count': attempts,
-        'scoring_mode': mode,
+        'scoring_mode': config['scoring_mode'],
         'L1': L1,
         'L2': L2
     }
 
+    def rate(hits):
+        # No rate can be given if no test cases were evaluated
+        return hits / len(all_pos_ranks) if all_pos_ranks else np.nan
+
     r['positive_label_ranks'] = all_pos_ranks
     r['total_evaluations_count'] = len(all_pos_ranks)
     r['hits@10'] = len([1 for i in all_pos_ranks if i < 10])
-    r['HR@10'] = r['hits@10'] / r['total_evaluations_count']
+    r['HR@10'] = rate(r['hits@10'])
     r['hits@5'] = len([1 for i in all_pos_ranks if i < 5])
-    r['HR@5'] = r['hits@5'] / r['total_evaluations_count']
+    r['HR@5'] = rate(r['hits@5'])
     r['hits@1'] = len([1 for i in all_pos_ranks if i < 1])
-    r['HR@1'] = r['hits@1'] / r['total_evaluations_count']
-    r['median_label_positive_rank'] = np.median(all_pos_ranks)
+    r['HR@1'] = rate(r['hits@1'])
+    r['median_label_positive_rank'] = np.median(all_pos_ranks) if all_pos_ranks else np.nan
     r['mean_label_positive_rank'] = util.mean(all_pos_ranks)
 
     r['text'] += f'\
@@ -170,43 +281,139 @@ EACH RANKED OUT OF {poolsize-1} RANDOM ITEMS {attempts} TIMES'
     return r
 
 
-def doCase(case, items, relation_pos, mode, L1, L2, poolsize):
+def readPartial(path, config=None):
+    """
+    Returns the settings and test case results saved in a partial results file
+    If config is set, the file must have been created with the same settings
+    A missing or empty file has no results
+    """
+    if not os.path.isfile(path):
+        return []
+
+    print(f"\nREADING PARTIAL RESULTS FILE: {path}")
+    saved = None
+    results = []
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # The last line may be incomplete if a run was interrupted
+                continue
+            if 'config' in record:
+                saved = record['config']
+            else:
+                results.append(record)
+
+    if config is not None and saved is not None and saved != config:
+        raise ValueError(f'{path} was created with different settings: {saved}')
+
+    print(f"FOUND {len(results)} COMPLETED TEST CASES")
+    return results
+
+
+def mergePartials(paths):
+    """
+    Combines the results of several partial results files, such as one per shard
+    All files must have been created with the same settings
+    Returns one result for each (L1, L2) combination evaluated,
+    with a warning in its text if any test cases are missing
+    """
+    config = None
+    results = {}
+    for path in paths:
+        with open(path) as f:
+            saved = json.loads(f.readline())['config']
+        if config is None:
+            config = saved
+        elif saved != config:
+            raise ValueError(f'{path} was created with different settings: {saved}')
+
+        # A case may appear in more than one file if shards overlap
+        for result in readPartial(path):
+            results[result['case']] = result
+
+    results = list(results.values())
+    summaries = [summariseResults(results, config, g) for g in range(len(config['grid']))]
+
+    # Check every shard was included and has completed
+    missing = config['case_count'] - len(results)
+    if missing:
+        warning = (f'WARNING: {missing} OF {config["case_count"]} TEST CASES ARE MISSING '
+                   f'FROM {len(paths)} FILES FOR {config["shard_count"]} SHARDS, RESULTS ARE INCOMPLETE')
+        print('\n' + warning)
+        for r in summaries:
+            r['text'] += '\n' + warning
+    return summaries
+
+
+_items = None  # Dataset shared by all test cases evaluated in this process
+
+
+def _initWorker(items):
+    global _items
+    _items = items
+
+
+def doCase(case, relation_pos, mode, grid, poolsize):
+    """
+    Ranks the known positive of a test case among its random pool
+    Routes are found once for the largest L1 and L2 in grid, then ranked for each (L1, L2)
+    """
     try:
 
         pos_id = case["pos_id"]
         query = case["query"]
 
         # Remove the query from the dataset
-        safe_items = items.copy()
-        safe_items.remove(query)
+        safe_items = [item for item in _items if item['id'] != query['id']]
 
         # Strip all labels from the query
         safe_query = copy.deepcopy(query)
         safe_query[relation_pos] = []
 
-        # Rank
-        ranked = core.infer(
-            max_similar=L1,
-            max_related=L2,
+        # Find routes for the largest L1 and L2 (0 is unlimited)
+        L1s = [L1 for L1, L2 in grid]
+        L2s = [L2 for L1, L2 in grid]
+        routes = core.findRoutes(
+            max_similar=0 if 0 in L1s else max(L1s),
+            max_related=0 if 0 in L2s else max(L2s),
             query=safe_query,
             items=safe_items,
             allowed_target_ids=case["target_ids"],
-            relation_type=relation_pos,
-            mode=mode
+            relation_type=relation_pos
         )
 
-        # Determine the ranking of the known positive
-        ranked_ids = [item["target_id"] for item in ranked]
-        pos_rank = ranked_ids.index(
-            pos_id) if pos_id in ranked_ids else poolsize
+        pos_index = case["target_ids"].index(pos_id)
+
+        pos_ranks = []
+        for L1, L2 in grid:
+
+            # Score
+            scores, discovered = core.scoreTargets(
+                routes, mode, case["target_ids"], L1, L2)
+
+            # Determine the ranking of the known positive
+            pos_rank = core.targetRank(scores, discovered, pos_index)
+            if pos_rank is None:
+                pos_rank = poolsize
+            pos_ranks.append(pos_rank)
 
         print(f'\
 QUERY: {str(safe_query["id"]).ljust(5)} \
 TARGET: {str(pos_id).ljust(5)} \
 ATTEMPT: {str(case["attempt"]).ljust(5)} \
-POSITIVE LABEL RANK: {pos_rank}')
-
-        return (pos_id, pos_rank)
+POSITIVE LABEL RANK: {" ".join(str(rank) for rank in pos_ranks)}')
+
+        return {
+            'case': case["case"],
+            'query_id': query["id"],
+            'pos_id': pos_id,
+            'attempt': case["attempt"],
+            'ranks': pos_ranks
+        }
 
     except:
         traceback.print_exc()
@@ -22,6 +22,16 @@ def main():
                         help="Scoring algorithm (a to q)")
     parser.add_argument("--query", "-q", type=int,
                         help="Index of the query. Items will be listed on start if not set")
+    parser.add_argument("--top", "-k", type=int,
+                        help="Number of top targets to output. All targets are output if not set")
+    parser.add_argument("--max-relations", type=int,
+                        help="Maximum number of relations to follow from each similar item. Unlimited if not set")
+    parser.add_argument("--relation-order", choices=['closeness', 'weight'], default='closeness',
+                        help="Which relations to follow when capped: closest to the query or highest stored weight")
+    parser.add_argument("--precision", choices=['float16', 'int8'],
+                        help="Quantise embeddings to reduce memory use. Full precision if not set")
+    parser.add_argument("--rerank", type=int, default=100,
+                        help="Number of nearest items to recalculate exactly when quantising embeddings")
 
     args = parser.parse_args()
 
@@ -36,11 +46,14 @@ def main():
 
     outPath = args.out or '.'
     queryIndex = args.query
+    top_k = args.top
 
     items = util.readJSONFile(inPath)
 
     # Pre-calculate cosine distance for all items
-    items = core.distancesSemantic(items)
+    items = core.distancesSemantic(items, args.precision, args.rerank)
+
+    print(f"\nRELATION {relation_pos} DEGREES: {core.relationDegrees(items, relation_pos)}")
 
     query = getQuery(items, queryIndex)
 
@@ -48,24 +61,33 @@ def main():
     target_ids = [item['id'] for item in items if item is not query]
 
     # Remove the query from the dataset
-    safe_items = items.copy()
-    safe_items.remove(query)
+    safe_items = [item for item in items if item['id'] != query['id']]
 
     # Strip all labels from the query
     safe_query = copy.deepcopy(query)
     safe_query[relation_pos] = []
 
-    # Rank
-    ranked = core.infer(
+    # Find all routes, without the pruning infer does for top_k,
+    # so every route to each listed target is written out
+    stats = {}
+    routes = core.findRoutes(
         max_similar=5,
         max_related=10,
         query=safe_query,
         items=safe_items,
         allowed_target_ids=target_ids,
         relation_type=relation_pos,
-        mode=mode
+        max_relations=args.max_relations,
+        relation_order=args.relation_order,
+        stats=stats
     )
 
+    # Rank
+    ranked = core.rankRoutes(routes, mode, top_k=top_k)
+
+    if stats:
+        print(f"\nRELATIONS CAPPED FOR {stats['capped']} SIMILAR ITEMS, SKIPPING {stats['skipped']} RELATIONS")
+
     outFile = f"{outPath}/{query['name'].replace('/',' ')}.{relation_pos}.TSR-{mode}.txt"
     outputScores(ranked, query, outFile)
 
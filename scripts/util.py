@@ -19,6 +19,15 @@ def readJSONFile(path):
     return data
 
 
+def writeJSONFile(path, data):
+    """
+    Writes data to a JSON file at path, replacing any existing file
+    """
+    print(f"\nSAVING JSON FILE: {path}")
+    with open(path, 'w', encoding='utf8') as json_file:
+        json.dump(data, json_file)
+
+
 def writeCSV(file_path, data, ignore=[]):
     """
     Writes data, a list of dicts, to a CSV file at file_path